@@ -3,36 +3,38 @@
 Extract bill information from PDF files and generate a report.
 """
 
-from datetime import date
-from email.mime import text
 import sys
 
 try:
     import coloredlogs
     import csv
+    import hashlib
+    import importlib
     import locale
     import logging
+    import multiprocessing
     import os
-    import pdfplumber
     import re
     import sys
     import yaml
     from argparse import ArgumentParser, RawTextHelpFormatter
+    from collections import defaultdict
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from contextlib import contextmanager
     from datetime import datetime
     from dotenv import load_dotenv
+    from functools import lru_cache
+    from itertools import chain, islice
     from openpyxl import Workbook
     from openpyxl.worksheet.worksheet import Worksheet
     from openpyxl import load_workbook
     from openpyxl.utils.dataframe import dataframe_to_rows
     from os.path import basename, join, dirname, isfile, isdir
     from pprint import pprint
+    from types import SimpleNamespace
     from pathlib import Path
     import textfsm
-    import gspread
     import pandas as pd
-    from gspread_dataframe import set_with_dataframe, get_as_dataframe
-    from google.oauth2.service_account import Credentials
-    from googleapiclient.discovery import build
     import sqlite3
     import json
 except ModuleNotFoundError as e:
@@ -42,6 +44,122 @@ except ModuleNotFoundError as e:
 load_dotenv()
 logger = logging.getLogger()
 
+# The extraction settings of a worker process, set once by _init_worker
+_worker_dispatchers = None
+_worker_pdf_parser = None
+
+PDF_PARSERS = ["pdfplumber", "pypdf", "pypdfium2"]
+
+# The columns converted to float after parsing a bill
+BILL_NUMERIC_COLUMNS = [
+    "billed_amount",
+    "billed_energy",
+    "billed_power",
+    "P1",
+    "P2",
+    "P3",
+    "P4",
+    "P5",
+    "P6",
+    "CP1",
+    "CP2",
+    "CP3",
+    "CP4",
+    "CP5",
+    "CP6",
+]
+NUFRI_NUMERIC_COLUMNS = [
+    "billed_amount",
+    "billed_energy",
+    "billed_power",
+    "P1",
+    "P2",
+    "P3",
+    "P4",
+    "P5",
+    "P6",
+]
+TE_NUMERIC_COLUMNS = [
+    "billed_amount",
+    "te_power_access_P1",
+    "te_power_access_P2",
+    "te_power_access_P3",
+    "te_power_access_P4",
+    "te_power_access_P5",
+    "te_power_access_P6",
+    "te_power_P1",
+    "te_power_P2",
+    "te_power_P3",
+    "te_power_P4",
+    "te_power_P5",
+    "te_power_P6",
+    "te_power_charge_P1",
+    "te_power_charge_P2",
+    "te_power_charge_P3",
+    "te_power_charge_P4",
+    "te_power_charge_P5",
+    "te_power_charge_P6",
+    "te_energy_access_P1",
+    "te_energy_access_P2",
+    "te_energy_access_P3",
+    "te_energy_access_P4",
+    "te_energy_access_P5",
+    "te_energy_access_P6",
+    "te_energy_P1",
+    "te_energy_P2",
+    "te_energy_P3",
+    "te_energy_P4",
+    "te_energy_P5",
+    "te_energy_P6",
+    "te_energy_charge_P1",
+    "te_energy_charge_P2",
+    "te_energy_charge_P3",
+    "te_energy_charge_P4",
+    "te_energy_charge_P5",
+    "te_energy_charge_P6",
+    "P1",
+    "P2",
+    "P3",
+    "P4",
+    "P5",
+    "P6",
+]
+
+# Spanish to float number notation: drop the thousands separator and use a decimal point
+DECIMAL_TRANSLATION = str.maketrans({".": None, ",": "."})
+
+# The fields every bill must have, the others (e.g. P4 to P6) are optional
+REQUIRED_BILL_KEYS = (
+    "holder",
+    "bill_id",
+    "billing_date",
+    "billing_period_start",
+    "billing_period_end",
+    "cups",
+    "contract_type",
+    "billed_power",
+    "billed_energy",
+    "billed_amount",
+)
+
+# The tariff periods, only the first three are present in every bill
+PERIODS = ("P1", "P2", "P3", "P4", "P5", "P6")
+MANDATORY_PERIODS = PERIODS[:3]
+
+# The amounts every bill must have, with their label in the error messages
+BILLED_AMOUNTS = {
+    "billed_power": "billed power capacity",
+    "billed_energy": "billed energy consumed",
+    "billed_amount": "billed amount",
+}
+
+# Contracted power per period, e.g. 'P1 3,45 kW P2 3,45 kW'. The unit is
+# required for Nufri bills, where it tells the power apart from other numbers.
+NUFRI_CONTRACTED_POWER_PATTERN = re.compile(r"(P[1-6])\s+([\d,]+)\s+kW")
+TE_CONTRACTED_POWER_PATTERN = re.compile(r"(P[1-6])\s+([\d,]+)")
+# Bill id already transformed into a link by the AppScript
+HYPERLINK_PATTERN = re.compile(r'=HYPERLINK\(".*?";\s*"([^"]+)"\)')
+
 
 def main():
     with open(join(dirname(__file__), "defaults.yaml"), "r", encoding="utf-8") as f:
@@ -49,32 +167,53 @@ def main():
     args = parse_command_line(defaults)
     args.defaults = defaults
     try:
-        # locale.setlocale(locale.LC_TIME, 'Spanish_Spain.1252')  # On Windows
-        locale.setlocale(locale.LC_NUMERIC, args.locale)
-        locale.setlocale(locale.LC_TIME, args.locale)
-        for verbose_package in [
-            "pdfminer.pdfpage",
-            "pdfminer.pdfdocument",
-            "pdfminer.psparser",
-            "pdfminer.pdfinterp",
-            "pdfminer.cmapdb",
-            "pdfminer.pdfparser",
-            "googleapiclient.discovery_cache",
-        ]:
-            verbose_logger = logging.getLogger(verbose_package)
-            verbose_logger.setLevel(level=logging.ERROR)
+        _setup_locale(args.locale)
         if args.debug:
-            coloredlogs.install(level=logging.DEBUG, logger=logger)
+            args.log_level = logging.DEBUG
         elif args.quiet:
-            coloredlogs.install(level=logging.ERROR, logger=logger)
+            args.log_level = logging.ERROR
         else:
-            coloredlogs.install(level=logging.INFO, logger=logger)
+            args.log_level = logging.INFO
+        _setup_logging(args.log_level)
         return args.func(args)
     except Exception as e:
         logging.error(e, exc_info=True)
         return 1
 
 
+def _setup_locale(locale_name: str):
+    """Set the locale used to parse the dates found in the bills
+
+    The numbers are converted by _spanish_atof, which does not depend on the
+    locale, therefore only LC_TIME is set.
+
+    Args:
+        locale_name (str): the locale name (e.g. 'es_ES.utf8')
+    """
+    # locale.setlocale(locale.LC_TIME, 'Spanish_Spain.1252')  # On Windows
+    locale.setlocale(locale.LC_TIME, locale_name)
+
+
+def _setup_logging(level: int):
+    """Install the colored logging handler and silence the verbose packages
+
+    Args:
+        level (int): the logging level
+    """
+    for verbose_package in [
+        "pdfminer.pdfpage",
+        "pdfminer.pdfdocument",
+        "pdfminer.psparser",
+        "pdfminer.pdfinterp",
+        "pdfminer.cmapdb",
+        "pdfminer.pdfparser",
+        "googleapiclient.discovery_cache",
+    ]:
+        verbose_logger = logging.getLogger(verbose_package)
+        verbose_logger.setLevel(level=logging.ERROR)
+    coloredlogs.install(level=level, logger=logger)
+
+
 def parse_command_line(defaults):
     parser = ArgumentParser(
         prog="extract_bill_information",
@@ -101,6 +240,13 @@ def parse_command_line(defaults):
         required=False,
         default=defaults["locale"],
     )
+    parser.add_argument(
+        "--pdf-parser",
+        choices=PDF_PARSERS,
+        help=f"The library used to extract the text of the bills. By default '{defaults['pdf-parser']}'.",
+        required=False,
+        default=defaults["pdf-parser"],
+    )
     parser.add_argument(
         "--use-cache",
         action="store_true",
@@ -115,6 +261,13 @@ def parse_command_line(defaults):
         help="Do not use the cache.",
         required=False,
     )
+    parser.add_argument(
+        "--force-refresh",
+        action="store_true",
+        help="Extract all the bills again and refresh the cache. Default to 'False'.",
+        required=False,
+        default=False,
+    )
     parser.add_argument(
         "--bill-input",
         help=f"The path where the bills are located. Either a directory where all bills will be processed or a file for just one bill. By default '{defaults['bill-input']}'.",
@@ -270,21 +423,20 @@ def extract_bill_information(args):
             return 1
 
         if args.dump:
-            _dump_bills(args.dump_prefix, bills)
+            _dump_bills(args.dump_prefix, args.pdf_parser, bill_files)
             return 0
 
         bills = _extract_bills(args, bill_files)
         loads = {}
         if args.include_loads:
             loads = _extract_loads(args, load_files)
-        wb = _generate_workbook(args, bills, loads)
+        _generate_workbook(args, bills, loads)
     else:
         if not isfile(args.workbook):
             logger.error(f"Workbook '{args.workbook}' does not exist.")
             return 1
         logger.info(
-            f"Loading previously generated workbook '{args.workbook}' ...")
-        wb = load_workbook(args.workbook, data_only=True)
+            f"Using previously generated workbook '{args.workbook}' ...")
 
     if args.upload:
         if not args.gsheet_id:
@@ -293,8 +445,12 @@ def extract_bill_information(args):
             )
             return 1
         bill_id_column = args.defaults["column_labels"]["bill_id"]
-        _upload_report(wb, bill_id_column, args.credentials,
-                       args.gsheet_id, args.incremental)
+        wb = load_workbook(args.workbook, read_only=True, data_only=True)
+        try:
+            _upload_report(wb, bill_id_column, args.credentials,
+                           args.gsheet_id, args.incremental)
+        finally:
+            wb.close()
 
     return 0
 
@@ -311,56 +467,117 @@ def _list_files_to_process(args):
     bills = loads = []
 
     bills = _list_files_with_extension(
-        args.bill_input, args.bill_input_excludes, "pdf")
+        args.bill_input, args.bill_input_excludes, "pdf", args.limit)
     if bills:
         logger.info(f"Found {len(bills)} bills in '{args.bill_input}'.")
 
     if args.include_loads:
         loads = _list_files_with_extension(
-            args.load_input, args.load_input_excludes, "csv")
+            args.load_input, args.load_input_excludes, "csv", args.limit)
         if loads:
             logger.info(f"Found {len(loads)} loads in '{args.bill_input}'.")
 
     if args.limit > 0 and (bills or loads):
-        bills = bills[: args.limit]
-        loads = loads[: args.limit]
         logger.warning(
             f"Limiting to {args.limit} bills as per the --limit argument.")
 
     return bills, loads
 
 
-def _list_files_with_extension(input, excludes, extension):
+def _list_files_with_extension(input, excludes, extension, limit=-1):
     """Return the list of file with the specific extension
 
+    The directory is walked lazily, and the walk stops as soon as `limit` files are found.
+
     Args:
         input (str): the input, either a file or a directory
         excludes (list): a list of  regexp expression to exclude when walking from the input directory
         extension (str): the file extension to look for
+        limit (int, optional): the maximum number of files to return. Defaults to -1 (no limit).
 
     Returns:
         list: the list of included files
     """
-    input_excludes = [re.compile(exclude)for exclude in excludes]
+    # Each exclude is compiled on its own, so that it keeps its inline flags
+    # and group numbers. An empty exclude would match any path, it is
+    # therefore ignored.
+    input_excludes = [
+        re.compile(exclude) for exclude in _flatten_excludes(excludes) if exclude
+    ]
+    suffix = f".{extension}"
     if isfile(input):
         files = [input]
     else:
-        files = [
+        files = (
             full_path
-            for dp, dn, filenames in os.walk(input)
-            for filename in filenames
-            for full_path in [join(dp, filename)]
-            if filename.lower().endswith(f".{extension}")
-            and not any(regex.search(full_path) for regex in input_excludes)
-        ]
-    return files
+            for full_path in _iter_files_with_suffix(input, suffix)
+            if not any(regex.search(full_path) for regex in input_excludes)
+        )
+    return list(islice(files, limit if limit > 0 else None))
+
+
+def _flatten_excludes(excludes):
+    """Yield each exclude regexp found in the excludes
+
+    The default excludes are parsed by argparse into a list of strings, while
+    each '--*-input-excludes' argument given on the command line is parsed
+    into its own list, hence the nesting.
+
+    Args:
+        excludes (list): the excludes, possibly nested in lists
+
+    Yields:
+        str: each exclude regexp
+
+    Raises:
+        TypeError: if an exclude is neither a string nor a list
+    """
+    for exclude in excludes:
+        if isinstance(exclude, str):
+            yield exclude
+        elif isinstance(exclude, (list, tuple)):
+            yield from _flatten_excludes(exclude)
+        else:
+            raise TypeError(
+                f"Invalid exclude {exclude!r}: expected a regexp string.")
 
 
-def _dump_bills(dump_prefix, bills):
+def _iter_files_with_suffix(directory, suffix):
+    """Walk a directory tree and yield the files with the given suffix
+
+    Like os.walk, the files of a directory are yielded before descending into
+    its sub directories, and symbolic links to directories are not followed.
+    Contrary to os.walk, the type of each entry is taken from the directory
+    listing itself, without a stat() call per file.
+
+    Args:
+        directory (str): the directory to walk
+        suffix (str): the lower case suffix of the files to yield
+
+    Yields:
+        str: the path of each matching file
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    sub_directories = []
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_directories.append(entry.path)
+            elif entry.name.lower().endswith(suffix):
+                yield entry.path
+    for sub_directory in sub_directories:
+        yield from _iter_files_with_suffix(sub_directory, suffix)
+
+
+def _dump_bills(dump_prefix, pdf_parser, bills):
     """Dump extracted text from a list of bills to a specific folder
 
     Args:
         dump_prefix (str): the output prefix
+        pdf_parser (str): the library used to extract the text
         bills (list): the list of pdf files to extract and dump
     """
     for bill in bills:
@@ -368,9 +585,9 @@ def _dump_bills(dump_prefix, bills):
         with open(
             f"{dump_prefix}{basename(bill).replace(".pdf", "")}.txt", "w", encoding="utf-8"
         ) as f:
-            with pdfplumber.open(bill) as pdf:
-                for page in pdf.pages:
-                    f.write(page.extract_text())
+            with _open_pdf(bill, pdf_parser) as pdf:
+                for text in _page_texts(pdf.pages):
+                    f.write(text)
     logger.info(
         f"Dumped {len(bills)} bills to {dirname(dump_prefix)}. Exiting."
     )
@@ -379,6 +596,14 @@ def _dump_bills(dump_prefix, bills):
 def _extract_bills(args, files: list):
     """Process all the input bills and construct a dict by CUPS/BILL_ID with all the relevant information
 
+    The bills that are not already in the cache are extracted in parallel, one
+    worker process per CPU, as each bill is independent from the others. The
+    files are hashed in background threads, and each bill missing from the
+    cache is submitted as soon as its digest is known, so that reading the
+    files overlaps with parsing the bills. The same bill is sometimes
+    downloaded twice under different names: only the first file having a
+    given digest is extracted and reported.
+
     Args:
         args (namespace): the input arguments
         files (list): the list of files to process
@@ -387,42 +612,118 @@ def _extract_bills(args, files: list):
         dict: a dict of CUPS/BILL_ID with all the extracted information
     """
     known_bills = {}
+    digests = {}
+    first_files = {}
     conn = None
+    files = sorted(files)
     if args.use_cache:
-        conn, known_bills = _load_cache(args.defaults['cache-file'])
-    bills = {}
+        conn, known_bills = _load_cache(
+            args.defaults['cache-file'], args.pdf_parser)
+        if args.force_refresh:
+            known_bills = {}
+    extracted = {}
+    _check_extractors(args.defaults["dispatchers"])
+    # Report a missing PDF library once, before the workers try to import it
+    # (each --pdf-parser choice is named after its module)
+    _import_library(args.pdf_parser)
+    # The hashing threads are already running when the workers are started:
+    # forking a multi-threaded process may deadlock the children, while the
+    # initializer rebuilds all the state a fresh worker needs.
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    executor = ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_worker,
+        initargs=(args.locale, args.log_level,
+                  args.defaults["dispatchers"], args.pdf_parser),
+    )
+    hasher = ThreadPoolExecutor(max_workers=2)
     try:
-        for file in sorted(files):
-            if args.use_cache and basename(file) in known_bills:
-                logger.info("Using cache for bill '%s' ...",
-                            _readable_path(file))
-                bill_info = known_bills[basename(file)]
-            else:
-                bill_info = _extract_dispatcher(
-                    args.defaults["dispatchers"], file)
-                if not bill_info:
-                    continue
-                bill_info = _sanitize_bill(bill_info)
-                if not bill_info:
-                    logger.debug(f"Skipping {file} ...")
-                    continue
-                bill_info["file"] = basename(file)
-                if args.use_cache:
-                    _mark_as_processed(conn, bill_info)
-            cups = bill_info["cups"]
-            if cups not in bills:
-                bills[cups] = []
-            bills[cups].append(bill_info)
+        futures = {}
+        for file, digest in zip(files, hasher.map(_file_digest, files)):
+            if digest in first_files:
+                logger.info("Skipping bill '%s', identical to '%s' ...",
+                            _readable_path(file), _readable_path(first_files[digest]))
+                continue
+            first_files[digest] = file
+            digests[file] = digest
+            if digest not in known_bills:
+                futures[file] = executor.submit(_process_one, file)
+        for file, future in futures.items():
+            bill_info = future.result()
+            if not bill_info:
+                continue
+            if args.use_cache:
+                _mark_as_processed(conn, digests[file],
+                                   args.pdf_parser, bill_info)
+            extracted[file] = bill_info
     except KeyboardInterrupt:
         logger.info(f"Interrupted by user. Cleaning up. Please wait.")
     finally:
+        # Do not wait for the files still queued for hashing when interrupted
+        hasher.shutdown(cancel_futures=True)
+        executor.shutdown(cancel_futures=True)
         if conn:
             conn.close()
 
+    bills = defaultdict(list)
+    for file in files:
+        if file in extracted:
+            bill_info = extracted[file]
+        elif digests.get(file) in known_bills:
+            logger.info("Using cache for bill '%s' ...",
+                        _readable_path(file))
+            bill_info = dict(known_bills[digests[file]])
+            bill_info["file"] = basename(file)
+        else:
+            continue
+        bills[bill_info["cups"]].append(bill_info)
+
     return bills
 
 
-def _extract_dispatcher(dispatchers: dict, file: str):
+def _init_worker(locale_name: str, log_level: int, dispatchers: dict, pdf_parser: str):
+    """Initialize a worker process of the extraction pool.
+
+    The locale and the logging handlers are process-local, therefore they
+    must be set up again in each worker. The extraction settings are sent
+    once per worker here, rather than pickled along with every bill.
+
+    Args:
+        locale_name (str): the locale used to parse the bills
+        log_level (int): the logging level
+        dispatchers (dict): A dictionary mapping dispatcher names (str) to extractor function names (str).
+        pdf_parser (str): The library used to extract the text of the bills.
+    """
+    global _worker_dispatchers, _worker_pdf_parser
+    _setup_locale(locale_name)
+    _setup_logging(log_level)
+    _worker_dispatchers = dispatchers
+    _worker_pdf_parser = pdf_parser
+
+
+def _process_one(file: str):
+    """Extract and sanitize a single bill. Runs in a worker process.
+
+    Args:
+        file (str): The path to the PDF file to be processed.
+
+    Returns:
+        dict: the sanitized bill information, or None if the bill could not be extracted.
+    """
+    bill_info = _extract_dispatcher(
+        _worker_dispatchers, _worker_pdf_parser, file)
+    if not bill_info:
+        return None
+    bill_info = _sanitize_bill(bill_info)
+    if not bill_info:
+        logger.debug(f"Skipping {file} ...")
+        return None
+    bill_info["file"] = basename(file)
+    return bill_info
+
+
+def _extract_dispatcher(dispatchers: dict, pdf_parser: str, file: str):
     """
     Extracts bill information by selecting and invoking the
     appropriate extractor function based on the content of
@@ -430,179 +731,215 @@ def _extract_dispatcher(dispatchers: dict, file: str):
 
     Args:
         dispatchers (dict): A dictionary mapping dispatcher names (str) to extractor function names (str).
+        pdf_parser (str): The library used to extract the text of the bill.
         file (str): The path to the PDF file to be processed.
 
     Returns:
         Any: The result of the extractor function if a matching dispatcher is found; otherwise, None.
-
-    Raises:
-        ValueError: If the specified extractor function is not found or is not callable.
-
     """
     logger.info("Extracting information from bill '%s' ...",
                 _readable_path(file))
-    with pdfplumber.open(file) as pdf:
-        first_page = pdf.pages[0].extract_text()
+    with _open_pdf(file, pdf_parser) as pdf:
+        first_page = next(_page_texts(pdf.pages))
         found_extractor = False
         for dispatcher, extractor in dispatchers.items():
-            if extractor not in globals() or not callable(globals()[extractor]):
-                raise ValueError(
-                    f"Extractor '{extractor}' not found or not callable.")
             if dispatcher in first_page:
                 logger.debug(
                     f"Detected '{dispatcher}' bill. Using {extractor} to extract information ..."
                 )
-                bill_info = globals()[extractor](pdf)
+                bill_info = globals()[extractor](pdf, first_page)
                 return bill_info
         if not found_extractor:
             logger.error(
                 f"Could not detect the type of bill for '{file}'. Skipping")
-            return None, None, None
+            return None
+
+
+def _check_extractors(dispatchers: dict):
+    """Check that every dispatcher maps to an extractor function
+
+    This is done once before extracting the bills, rather than for each bill.
+
+    Args:
+        dispatchers (dict): A dictionary mapping dispatcher names (str) to extractor function names (str).
+
+    Raises:
+        ValueError: If an extractor function is not found or is not callable.
+    """
+    for extractor in dispatchers.values():
+        if extractor not in globals() or not callable(globals()[extractor]):
+            raise ValueError(
+                f"Extractor '{extractor}' not found or not callable.")
+
+
+def _open_pdf(file: str, pdf_parser: str):
+    """Open a PDF file with the requested library
+
+    Both pdfplumber and pypdf expose a list of `pages` having an
+    `extract_text()` method, which is all the extractors need, and PDFium
+    pages are wrapped to offer the same interface. pypdf and PDFium skip the
+    layout analysis done by pdfplumber and are therefore much faster, but
+    their text may be laid out differently than what the templates expect.
+
+    Like the extractors, the opener of each library is looked up by name:
+    `_open_<pdf_parser>`. Each opener imports its own library, therefore only
+    the one selected with --pdf-parser is loaded by the workers.
+
+    Args:
+        file (str): The path to the PDF file
+        pdf_parser (str): either 'pdfplumber', 'pypdf' or 'pypdfium2'
+
+    Returns:
+        ContextManager: a context manager yielding the opened pdf file
+    """
+    return globals()[f"_open_{pdf_parser}"](file)
+
+
+@contextmanager
+def _open_pdfplumber(file: str):
+    """Open a PDF file with pdfplumber
+
+    Args:
+        file (str): The path to the PDF file
+
+    Yields:
+        PDF: the pdfplumber document, closed when the context exits
+    """
+    pdfplumber = _import_library("pdfplumber")
+
+    # pdfplumber groups the characters itself: the pdfminer layout analysis
+    # (LAParams) must stay disabled, it would only slow down every page
+    with pdfplumber.open(file, laparams=None) as pdf:
+        yield pdf
+
+
+@contextmanager
+def _open_pypdf(file: str):
+    """Open a PDF file with pypdf
+
+    Args:
+        file (str): The path to the PDF file
+
+    Yields:
+        PdfReader: the pypdf reader of the document
+    """
+    pypdf = _import_library("pypdf")
+
+    yield pypdf.PdfReader(file)
 
 
-def extract_plenitude_bill(pdf):
+@contextmanager
+def _open_pypdfium2(file: str):
+    """Open a PDF file with PDFium
+
+    Args:
+        file (str): The path to the PDF file
+
+    Yields:
+        SimpleNamespace: the `pages` of the document, wrapped as _PdfiumPage,
+            the document is closed when the context exits
+    """
+    pdfium = _import_library("pypdfium2")
+
+    pdf = pdfium.PdfDocument(file)
+    try:
+        yield SimpleNamespace(
+            pages=[_PdfiumPage(pdf, index) for index in range(len(pdf))])
+    finally:
+        pdf.close()
+
+
+def _page_texts(pages):
+    """Yield the text of each page, one page at a time
+
+    pdfplumber keeps the characters and objects of every parsed page in
+    memory until the page is closed, therefore each page is closed as soon
+    as its text has been extracted. The other libraries' pages have no close
+    method and are left as is.
+
+    Args:
+        pages (list): the pages of the pdf file
+
+    Yields:
+        str: the text of each page
+    """
+    for page in pages:
+        text = page.extract_text()
+        if hasattr(page, "close"):
+            page.close()
+        yield text
+
+
+class _PdfiumPage:
+    """A PDFium page offering the pdfplumber `extract_text()` interface
+
+    The page is only loaded when its text is extracted. PDFium ends the lines
+    with CRLF, they are normalized to LF like the text of pdfplumber.
+    """
+
+    def __init__(self, pdf, index: int):
+        self._pdf = pdf
+        self._index = index
+
+    def extract_text(self) -> str:
+        """Load the page and extract its text
+
+        Returns:
+            str: the text of the page, with LF line endings
+        """
+        page = self._pdf[self._index]
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range().replace("\r\n", "\n")
+        finally:
+            textpage.close()
+            page.close()
+
+
+def extract_plenitude_bill(pdf, first_page):
     """Extractor for plenitude bills
 
     Args:
         pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page, already extracted by the dispatcher
 
     Returns: 
         dict: A dictionary containing the extracted bill information.
     """
-    if not hasattr(extract_plenitude_bill, "re_table"):
-        extract_plenitude_bill.re_table = None
-    numeric_cols = [
-        "billed_amount",
-        "billed_energy",
-        "billed_power",
-        "P1",
-        "P2",
-        "P3",
-        "P4",
-        "P5",
-        "P6",
-        "CP1",
-        "CP2",
-        "CP3",
-        "CP4",
-        "CP5",
-        "CP6",
-    ]
-    with open(
-        join(dirname(__file__), "assets/templates/es.plenitude.textfsm"),
-        "r",
-        encoding="utf-8",
-    ) as template:
-        extract_plenitude_bill.re_table = textfsm.TextFSM(template)
-    df = _extract_bill(pdf, extract_plenitude_bill.re_table, numeric_cols)
+    re_table = _load_template("es.plenitude.textfsm")
+    df = _extract_bill(pdf, first_page, re_table, BILL_NUMERIC_COLUMNS)
     return df.iloc[0].to_dict()
 
 
-def extract_nufri_bill(pdf):
+def extract_nufri_bill(pdf, first_page):
     """Extractor for Nufri bills
 
     Args:
         pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page, already extracted by the dispatcher
 
     Returns:
         dict: A dictionary containing the extracted bill information.
     """
-    if not hasattr(extract_nufri_bill, "re_table"):
-        extract_nufri_bill.re_table = None
-
-    numeric_cols = [
-        "billed_amount",
-        "billed_energy",
-        "billed_power",
-        "P1",
-        "P2",
-        "P3",
-        "P4",
-        "P5",
-        "P6",
-    ]
-    with open(
-        join(dirname(__file__), "assets/templates/es.nufri.textfsm"),
-        "r",
-        encoding="utf-8",
-    ) as template:
-        extract_nufri_bill.re_table = textfsm.TextFSM(template)
-    df = _extract_bill(pdf, extract_nufri_bill.re_table, numeric_cols)
-    matches = re.findall(r"(P[1-6])\s+([\d,]+)\s+kW",
-                         df["nufri_contracted_power"][0])
-    if matches:
-        for i in range(1, 7):
-            df[f"CP{i}"] = 0.0
-        for k, v in dict(matches).items():
-            df[f"C{k}"] = locale.atof(v)
+    re_table = _load_template("es.nufri.textfsm")
+    df = _extract_bill(pdf, first_page, re_table, NUFRI_NUMERIC_COLUMNS)
+    _split_contracted_power(
+        df, "nufri_contracted_power", NUFRI_CONTRACTED_POWER_PATTERN)
     return df.iloc[0].to_dict()
 
 
-def extract_te_bill(pdf):
+def extract_te_bill(pdf, first_page):
     """Extractor for Total Energie bills
 
     Args:
         pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page, already extracted by the dispatcher
 
     Returns:
         dict: A dictionary containing the extracted bill information.
     """
-    if not hasattr(extract_te_bill, "re_table"):
-        extract_te_bill.re_table = None
-
-    numeric_cols = [
-        "billed_amount",
-        "te_power_access_P1",
-        "te_power_access_P2",
-        "te_power_access_P3",
-        "te_power_access_P4",
-        "te_power_access_P5",
-        "te_power_access_P6",
-        "te_power_P1",
-        "te_power_P2",
-        "te_power_P3",
-        "te_power_P4",
-        "te_power_P5",
-        "te_power_P6",
-        "te_power_charge_P1",
-        "te_power_charge_P2",
-        "te_power_charge_P3",
-        "te_power_charge_P4",
-        "te_power_charge_P5",
-        "te_power_charge_P6",
-        "te_energy_access_P1",
-        "te_energy_access_P2",
-        "te_energy_access_P3",
-        "te_energy_access_P4",
-        "te_energy_access_P5",
-        "te_energy_access_P6",
-        "te_energy_P1",
-        "te_energy_P2",
-        "te_energy_P3",
-        "te_energy_P4",
-        "te_energy_P5",
-        "te_energy_P6",
-        "te_energy_charge_P1",
-        "te_energy_charge_P2",
-        "te_energy_charge_P3",
-        "te_energy_charge_P4",
-        "te_energy_charge_P5",
-        "te_energy_charge_P6",
-        "P1",
-        "P2",
-        "P3",
-        "P4",
-        "P5",
-        "P6",
-    ]
-
-    with open(
-        join(dirname(__file__), "assets/templates/es.totalenergies.textfsm"),
-        "r",
-        encoding="utf-8",
-    ) as template:
-        extract_te_bill.re_table = textfsm.TextFSM(template)
-    df = _extract_bill(pdf, extract_te_bill.re_table, numeric_cols)
+    re_table = _load_template("es.totalenergies.textfsm")
+    df = _extract_bill(pdf, first_page, re_table, TE_NUMERIC_COLUMNS)
     # Do some summing
     df["billed_energy"] = df[
         [
@@ -619,51 +956,23 @@ def extract_te_bill(pdf):
         ]
     ].sum(axis=1)
     # unfortunately te_contracted_power is not easily extractible
-    matches = re.findall(r"(P[1-6])\s+([\d,]+)", df["te_contracted_power"][0])
-    if matches:
-        for i in range(1, 7):
-            df[f"CP{i}"] = 0.0
-        for k, v in dict(matches).items():
-            df[f"C{k}"] = locale.atof(v)
+    _split_contracted_power(
+        df, "te_contracted_power", TE_CONTRACTED_POWER_PATTERN)
     return df.iloc[0].to_dict()
 
 
-def extract_endesa_bill(pdf):
+def extract_endesa_bill(pdf, first_page):
     """Extractor for Endesa bills
 
     Args:
         pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page, already extracted by the dispatcher
 
     Returns:
         dict: A dictionary containing the extracted bill information.
     """
-    if not hasattr(extract_endesa_bill, "re_table"):
-        extract_endesa_bill.re_table = None
-    numeric_cols = [
-        "billed_amount",
-        "billed_power",
-        "billed_energy",
-        "P1",
-        "P2",
-        "P3",
-        "P4",
-        "P5",
-        "P6",
-        "CP1",
-        "CP2",
-        "CP3",
-        "CP4",
-        "CP5",
-        "CP6",
-    ]
-
-    with open(
-        join(dirname(__file__), "assets/templates/es.endesa.textfsm"),
-        "r",
-        encoding="utf-8",
-    ) as template:
-        extract_endesa_bill.re_table = textfsm.TextFSM(template)
-    df = _extract_bill(pdf, extract_endesa_bill.re_table, numeric_cols)
+    re_table = _load_template("es.endesa.textfsm")
+    df = _extract_bill(pdf, first_page, re_table, BILL_NUMERIC_COLUMNS)
     # I need to adjust the billing period end by -1 otherwise I
     # overshoot the contracted power calculation. Except when it's
     # just one day
@@ -680,65 +989,114 @@ def extract_endesa_bill(pdf):
     #         df[f"CP{i}"] = 0.0
     #     for k, v in dict(matches).items():
     #         if k == "punta" or k == "punta-llano":
-    #             df[f"CP1"] = locale.atof(v)
+    #             df[f"CP1"] = _spanish_atof(v)
     #         elif k == "valle":
-    #             df[f"CP3"] = locale.atof(v)
+    #             df[f"CP3"] = _spanish_atof(v)
     #         else:
     #             logger.warning(f"Unknown contracted power {k}")
     return df.iloc[0].to_dict()
 
 
-def extract_qener_bill(pdf):
+def extract_qener_bill(pdf, first_page):
     """Extractor for Qener bills
 
     Args:
         pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page, already extracted by the dispatcher
 
     Returns:
         dict: A dictionary containing the extracted bill information.
     """
-    if not hasattr(extract_qener_bill, "re_table"):
-        extract_qener_bill.re_table = None
-    numeric_cols = [
-        "billed_amount",
-        "billed_energy",
-        "billed_power",
-        "P1",
-        "P2",
-        "P3",
-        "P4",
-        "P5",
-        "P6",
-        "CP1",
-        "CP2",
-        "CP3",
-        "CP4",
-        "CP5",
-        "CP6",
-    ]
+    re_table = _load_template("es.qener.textfsm")
+    df = _extract_bill(pdf, first_page, re_table, BILL_NUMERIC_COLUMNS)
+    return df.iloc[0].to_dict()
+
+
+@lru_cache
+def _load_template(name: str):
+    """Load and compile a TextFSM template, once per process
+
+    Args:
+        name (str): the file name of the template in 'assets/templates'
+
+    Returns:
+        TextFSM: the compiled template, shared by all the bills of the same issuer
+    """
     with open(
-        join(dirname(__file__), "assets/templates/es.qener.textfsm"),
+        join(dirname(__file__), "assets/templates", name),
         "r",
         encoding="utf-8",
     ) as template:
-        extract_qener_bill.re_table = textfsm.TextFSM(template)
-    df = _extract_bill(pdf, extract_qener_bill.re_table, numeric_cols)
-    return df.iloc[0].to_dict()
+        return textfsm.TextFSM(template)
 
 
-def _extract_bill(pdf, re_table, numeric_columns):
-    pages = [page.extract_text() for page in pdf.pages]
+def _split_contracted_power(df, column: str, pattern):
+    """Split the contracted power of each period into the CP1 to CP6 columns
+
+    Args:
+        df (DataFrame): the extracted bill information
+        column (str): the column holding the contracted power (e.g. 'P1 3,45 kW P2 3,45 kW')
+        pattern (Pattern): the issuer's pattern capturing the period and its power
+    """
+    matches = pattern.findall(df[column][0])
+    if matches:
+        for i in range(1, 7):
+            df[f"CP{i}"] = 0.0
+        for k, v in dict(matches).items():
+            df[f"C{k}"] = _spanish_atof(v)
+
+
+def _spanish_atof(value: str) -> float:
+    """Convert a number in the Spanish notation (e.g. '1.234,56') to float
+
+    Unlike locale.atof, this does not query the locale conventions on each call
+    and does not depend on the thousands separator of the installed locale.
+
+    Args:
+        value (str): the number to convert
+
+    Returns:
+        float: the converted number
+
+    Raises:
+        ValueError: if the value is not a number
+    """
+    return float(value.translate(DECIMAL_TRANSLATION))
+
+
+def _extract_bill(pdf, first_page, re_table, numeric_columns):
+    """Parse the text of the bill with the given TextFSM template
+
+    The pages are fed one at a time to the template, and the remaining pages
+    are neither extracted nor parsed once the template has recorded the bill.
+    The text of the first page is reused from the dispatcher.
+
+    Args:
+        pdf (PDFfile): The corresponding pdf file
+        first_page (str): The text of the first page
+        re_table (TextFSM): the template used to parse the bill
+        numeric_columns (list): the columns to convert to float
+
+    Returns:
+        DataFrame: the parsed bill information
+    """
+    re_table.Reset()
     headers = re_table.header
-    data = re_table.ParseText("\n".join(pages))
+    data = []
+    texts = chain([first_page], _page_texts(pdf.pages[1:]))
+    for text in texts:
+        data = re_table.ParseText(text, eof=False)
+        if data:
+            break
+    if not data:
+        data = re_table.ParseText("", eof=True)
     df = pd.DataFrame(data, columns=headers)
     # Convert to float and fill with 0
     df[numeric_columns] = (
         df[numeric_columns]
         .apply(
             lambda serie: pd.to_numeric(
-                serie.astype(str)
-                .str.replace(".", "", regex=False)
-                .str.replace(",", ".", regex=False),
+                serie.astype(str).str.translate(DECIMAL_TRANSLATION),
                 errors="coerce",
             )
         )
@@ -775,49 +1133,44 @@ def _sanitize_bill(data: dict):
         )
         return None
 
-    if "billed_power" not in data:
-        logger.error(
-            f"Invalid billed power capacity (not in the expected format '+/-0.000,00 €') for CUPS {data['cups']} and bill {data['bill_id']}."
-        )
-        return None
-
-    if "billed_energy" not in data:
-        logger.error(
-            f"Invalid billed energy consumed (not in the expected format '+/-0.000,00 €') for CUPS {data['cups']} and bill {data['bill_id']}."
-        )
-        return None
-
-    if "billed_amount" not in data:
-        logger.error(
-            f"Invalid billed amount (not in the expected format '+/-0.000,00 €') for CUPS {data['cups']} and bill {data['bill_id']}."
-        )
-        return None
+    for amount, label in BILLED_AMOUNTS.items():
+        if amount not in data:
+            logger.error(
+                f"Invalid {label} (not in the expected format '+/-0.000,00 €') for CUPS {data['cups']} and bill {data['bill_id']}."
+            )
+            return None
 
-    for power_type in ["P1", "P2", "P3", "P4", "P5", "P6"]:
-        if power_type not in data and power_type in ["P1", "P2", "P3"]:
+    for power_type in MANDATORY_PERIODS:
+        if power_type not in data:
             logger.error(
                 f"Mandatory '{power_type}' comsumption has not been extracted from CUPS {data['cups']} and bill {data['bill_id']}."
             )
             return None
-        if (
-            power_type in data
-            and data[power_type] is not None
-            and type(data[power_type]) is str
-        ):  # P4, P5, P6
-            data[power_type] = locale.atof(data[power_type].strip())
+
+    for power_type in PERIODS:
+        value = data.get(power_type)
+        if isinstance(value, str):  # P4, P5, P6
+            data[power_type] = _spanish_atof(value.strip())
 
     return data
 
 
 def _is_bill_sane(data: dict):
-    # check that all the keys have a value
-    is_sane = True
-    missing_keys = []
-    for key, value in data.items():
-        if value is None or (isinstance(value, str) and not value.strip()):
-            missing_keys.append(key)
-            is_sane = False
-    return is_sane, missing_keys
+    """Check that the required fields of the bill have a value
+
+    Args:
+        data (dict): the extracted bill information
+
+    Returns:
+        tuple: whether the bill is sane and the list of the missing keys
+    """
+    missing_keys = [
+        key
+        for key in REQUIRED_BILL_KEYS
+        if (value := data.get(key)) is None
+        or (isinstance(value, str) and not value.strip())
+    ]
+    return not missing_keys, missing_keys
 
 
 def _readable_path(path: str, max_len: int = 70) -> str:
@@ -848,30 +1201,37 @@ def _readable_path(path: str, max_len: int = 70) -> str:
 
 
 def _extract_loads(args, files: list):
-    loads = {}
+    loads = defaultdict(dict)
     for file in files:
         with open(file, encoding="utf-8") as f:
-            reader = csv.DictReader(f, delimiter=";")
+            # Resolve the columns once instead of building a dict per row
+            reader = csv.reader(f, delimiter=";")
+            header = next(reader, None)
+            if not header:
+                continue
+            i_cups, i_fecha, i_hora, i_ae_kwh = (
+                header.index(column) for column in ("CUPS", "Fecha", "Hora", "AE_kWh")
+            )
             for row in reader:
-                cups = row["CUPS"].strip()
-                fecha = row["Fecha"].strip()
-                hora = row["Hora"].strip()
-                ae_kwh = row["AE_kWh"].strip()
+                if not row:
+                    continue
+                cups = row[i_cups].strip()
+                fecha = row[i_fecha].strip()
+                hora = row[i_hora].strip()
+                ae_kwh = row[i_ae_kwh].strip()
 
-                # Hora starts at 1, while datetime starts at 0
-                dt_str = f"{fecha} {int(hora)-1}"
                 try:
-                    dt = datetime.strptime(dt_str, "%d/%m/%Y %H")
+                    dt = _parse_load_datetime(fecha, hora)
                 except ValueError as e:
                     logger.error(
-                        f"Could not parse datetime '{dt_str}' in file '{file}': {str(e)}"
+                        f"Could not parse datetime '{fecha} {hora}' in file '{file}': {str(e)}"
                     )
                     continue
 
                 # Convert AE_kWh to float
                 try:
                     if ae_kwh != "":
-                        ae_kwh_val = locale.atof(ae_kwh)
+                        ae_kwh_val = _spanish_atof(ae_kwh)
                     else:
                         ae_kwh_val = 0.0
                 except ValueError as e:
@@ -880,19 +1240,57 @@ def _extract_loads(args, files: list):
                     continue
 
                 # Insert into loads dict
-                if cups not in loads:
-                    loads[cups] = {}
                 loads[cups][dt] = ae_kwh_val
     return loads
 
 
-def _generate_workbook(args, bills: dict, loads: dict) -> Workbook:
+def _parse_load_datetime(fecha: str, hora: str) -> datetime:
+    """Parse the date and hour of a load
+
+    The format is fixed, so the fields are converted directly instead of going
+    through datetime.strptime, which is slow when called for every hour. Each
+    date appears once per hour, therefore only the hour is set per row.
+
+    Args:
+        fecha (str): the date, in the 'dd/mm/yyyy' format
+        hora (str): the hour, from 1 to 24
+
+    Returns:
+        datetime: the start of the hour
+
+    Raises:
+        ValueError: if the date or the hour are invalid
+    """
+    # Hora starts at 1, while datetime starts at 0
+    return _parse_load_date(fecha).replace(hour=int(hora) - 1)
+
+
+@lru_cache
+def _parse_load_date(fecha: str) -> datetime:
+    """Parse the date of a load, once for all its hours
+
+    Args:
+        fecha (str): the date, in the 'dd/mm/yyyy' format
+
+    Returns:
+        datetime: the start of the day
+
+    Raises:
+        ValueError: if the date is invalid
+    """
+    day, month, year = fecha.split("/")
+    return datetime(int(year), int(month), int(day))
+
+
+def _generate_workbook(args, bills: dict, loads: dict):
     """
     Generates an Excel workbook report from provided bill information.
 
     For each CUPS (supply point) in the `bills` dictionary, a worksheet is created and populated
     with bill data. The worksheet names and column headers are determined by the `args.defaults`
     configuration. The resulting workbook is saved to the file path specified by `args.workbook`.
+    The workbook is created in write-only mode: the rows are streamed to the file instead of
+    being kept in memory, therefore it can not be read back once saved.
 
     Args:
         args: An object containing configuration options, including:
@@ -903,31 +1301,32 @@ def _generate_workbook(args, bills: dict, loads: dict) -> Workbook:
             dictionary containing bill information for that CUPS.
         loads (dict): A dictionary where each key is a CUPS identifier and each value is another
             dictionary containing load information for that CUPS.
-
-    Returns:
-        Workbook. The function generated workbook
     """
-    wb = Workbook()
+    wb = Workbook(write_only=True)
 
-    column_keys = list(args.defaults["column_labels"].keys())
-    column_headers = list(args.defaults["column_labels"].values())
+    column_labels = args.defaults["column_labels"]
+    column_keys = tuple(column_labels)
     sheet_names = args.defaults["sheet_names"]
 
-    ws = wb.active
-    ws.title = "Loads"
+    ws = wb.create_sheet(title="Loads")
     ws.append(["CUPS", "Fecha", "AE_kWh"])
     for cups, cups_loads in loads.items():
         for dt, load in cups_loads.items():
             ws.append([cups, dt, load])
 
-    sheets = {}
+    # In write-only mode the worksheets can not be reordered, therefore they
+    # are created in the order of the 'sheet_names'
+    ordered_cups = [cups for cups in sheet_names if cups in bills]
+    if len(ordered_cups) == 0:
+        ordered_cups = list(bills.keys())
+
     # Add a new worksheet for each CUPS
-    for cups, bill_infos in bills.items():
+    for cups in ordered_cups:
+        bill_infos = bills[cups]
         logger.info(
             f"Adding worksheet for CUPS '{cups}' with {len(bill_infos)} bills ..."
         )
         ws = wb.create_sheet(title=sheet_names.get(cups, cups))
-        sheets[ws.title] = ws
 
         # Enrich the report
         if args.no_trim_workbook:
@@ -935,34 +1334,31 @@ def _generate_workbook(args, bills: dict, loads: dict) -> Workbook:
         else:
             df = pd.DataFrame(bill_infos, columns=column_keys)
         df["gross_amount"] = df["billed_power"] + df["billed_energy"]
-        df = df.rename(columns=args.defaults["column_labels"])
 
-        # And write it in the worksheet
-        for row in dataframe_to_rows(df, index=False, header=True):
+        # And write it in the worksheet, the rows are flushed as they are
+        # appended therefore the DataFrame is the only copy kept in memory.
+        # The header is localized directly instead of renaming (and copying)
+        # the DataFrame.
+        ws.append([column_labels.get(column, column) for column in df.columns])
+        for row in dataframe_to_rows(df, index=False, header=False):
             ws.append(row)
-
-    ordered_sheets = []
-    for title in args.defaults["sheet_names"].values():
-        if title in sheets:
-            ordered_sheets.append(sheets[title])
-    if len(ordered_sheets) == 0:
-        ordered_sheets.extend(list(sheets.values()))
-    wb._sheets = [wb.worksheets[0]] + ordered_sheets
+        del df
 
     # Save the workbook
     wb.save(args.workbook)
-    return wb
 
 
 def _upload_report(workbook: Workbook, bill_id_column: str, cred_file: str, gsheet_id: str, incremental: bool):
+    google = _google_libraries()
     logger.info(
         msg=f"Uploading report to Google Sheets with ID '{gsheet_id}' ...")
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive.readonly",
     ]
-    creds = Credentials.from_service_account_file(cred_file, scopes=scopes)
-    g_spreadsheet = gspread.authorize(creds).open_by_key(gsheet_id)
+    creds = google.Credentials.from_service_account_file(
+        cred_file, scopes=scopes)
+    g_spreadsheet = google.gspread.authorize(creds).open_by_key(gsheet_id)
 
     for l_worksheet in workbook.worksheets:
         if incremental and l_worksheet.title != 'Loads':
@@ -971,7 +1367,7 @@ def _upload_report(workbook: Workbook, bill_id_column: str, cred_file: str, gshe
         else:
             _update_worksheet_overwrite(l_worksheet, g_spreadsheet)
 
-    drive = build("drive", "v3", credentials=creds)
+    drive = google.build("drive", "v3", credentials=creds)
     sheet = (
         drive.files()
         .get(
@@ -991,21 +1387,23 @@ def _update_worksheet_incremental(l_worksheet, g_spreadsheet, bill_id_column: st
         g_spreadsheet (GoogleWorkheet): the google worksheet to update
         bill_id_column (str): the column that represent the billd id (its localized form)
     """
+    google = _google_libraries()
     l_df = _get_df_from_worksheet(l_worksheet)
     l_title = l_worksheet.title
 
     try:
         g_worksheet = g_spreadsheet.worksheet(l_title)
-    except gspread.exceptions.WorksheetNotFound:
+    except google.gspread.exceptions.WorksheetNotFound:
         # Google worksheet does not exists ...
         logger.info(f"Creating new sheet '{l_title}' ...")
+        rows, cols = l_df.shape
         g_worksheet = g_spreadsheet.add_worksheet(
-            title=l_worksheet.title, rows=l_worksheet.max_row, cols=l_worksheet.max_column
+            title=l_title, rows=rows, cols=cols
         )
         _write_to_worksheet(l_df, g_worksheet)
         return
 
-    g_df = get_as_dataframe(g_worksheet)
+    g_df = google.get_as_dataframe(g_worksheet)
     if len(g_df) <= 1:
         # Google worksheet is empty ...
         logger.info(f"Overwriting empty sheet '{l_title}' ...")
@@ -1023,12 +1421,12 @@ def _update_worksheet_incremental(l_worksheet, g_spreadsheet, bill_id_column: st
 
     def _extract_bill_id(value):
         if pd.isna(value): return value
-        m = re.match(
-            r'=HYPERLINK\(".*?";\s*"([^"]+)"\)',
-            str(value)
-        )
+        value = str(value)
         # Either a plain bill id or an already transformed hyperlink
-        return m.group(1) if m else str(value)
+        if not value.startswith("=HYPERLINK("):
+            return value
+        m = HYPERLINK_PATTERN.match(value)
+        return m.group(1) if m else value
 
     g_bill_ids = g_df[bill_id_column].apply(_extract_bill_id)
     new_bills = l_df.loc[~l_df[bill_id_column].isin(g_bill_ids)]
@@ -1050,13 +1448,14 @@ def _update_worksheet_overwrite(l_worksheet, g_spreadsheet):
         l_worksheet (worksheet): the openpyxl worksheet
         g_spreadsheet (Google worksheet): the Google worksheet to update
     """
+    google = _google_libraries()
     l_df = _get_df_from_worksheet(l_worksheet)
     l_title = l_worksheet.title
 
     try:
         g_worksheet = g_spreadsheet.worksheet(l_title)
         g_spreadsheet.del_worksheet(g_worksheet)
-    except gspread.exceptions.WorksheetNotFound:
+    except google.gspread.exceptions.WorksheetNotFound:
         pass
     rows, cols = l_df.shape
     g_worksheet = g_spreadsheet.add_worksheet(
@@ -1072,8 +1471,46 @@ def _write_to_worksheet(l_df, g_worksheet):
         l_df (dataframe): the pandas dataframe
         g_worksheet (Google Worksheet): the Google worksheet to update
     """
-    set_with_dataframe(g_worksheet, l_df, include_index=False,
-                       include_column_header=True)
+    _google_libraries().set_with_dataframe(
+        g_worksheet, l_df, include_index=False, include_column_header=True)
+
+
+@lru_cache
+def _google_libraries():
+    """Import the Google libraries, which are only needed to upload the report
+
+    Returns:
+        SimpleNamespace: the gspread module, the Credentials class, the build
+            function of the Google API client and the gspread_dataframe functions
+    """
+    gspread_dataframe = _import_library("gspread_dataframe")
+    return SimpleNamespace(
+        gspread=_import_library("gspread"),
+        Credentials=_import_library(
+            "google.oauth2.service_account").Credentials,
+        build=_import_library("googleapiclient.discovery").build,
+        get_as_dataframe=gspread_dataframe.get_as_dataframe,
+        set_with_dataframe=gspread_dataframe.set_with_dataframe,
+    )
+
+
+def _import_library(name: str):
+    """Import a library that only some runs need, e.g. the selected PDF library
+
+    Like the imports at the top of this file, a missing library ends the run
+    with a hint to load the environment, rather than with a traceback.
+
+    Args:
+        name (str): the name of the module to import
+
+    Returns:
+        module: the imported module
+    """
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError as e:
+        print(f"{e}. Did you load your environment?")
+        sys.exit(1)
 
 
 def _get_df_from_worksheet(l_worksheet):
@@ -1091,41 +1528,93 @@ def _get_df_from_worksheet(l_worksheet):
     return l_df
 
 
-def _load_cache(cache_file: Path):
+def _load_cache(cache_file: Path, pdf_parser: str):
     """load the cache from the given sqlite database
 
+    Only the bills extracted with the same library are returned, as the text
+    of the other libraries may be parsed differently by the templates.
+
     Args:
         cache_file (Path): the path to the sqlite database
+        pdf_parser (str): the library used to extract the text of the bills
 
     Returns:
-        tuple: the sqlite connection and a dict of known bill, with the filename as key
+        tuple: the sqlite connection and a dict of known bill, with the file digest as key
     """
     conn = sqlite3.connect(cache_file)
     conn.execute("""
-    CREATE TABLE IF NOT EXISTS extracted_bills (
-        file TEXT PRIMARY KEY,
+    CREATE TABLE IF NOT EXISTS cached_bills (
+        digest TEXT NOT NULL,
+        pdf_parser TEXT NOT NULL,
+        file TEXT,
         bill_info TEXT,
-        exctracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        exctracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (digest, pdf_parser)
     )
     """)
+    _migrate_cache(conn)
     conn.commit()
-    cur = conn.execute("SELECT file, bill_info FROM extracted_bills")
+    cur = conn.execute(
+        "SELECT digest, bill_info FROM cached_bills WHERE pdf_parser = ?",
+        (pdf_parser, ))
     known_bills = {row[0]: json.loads(row[1]) for row in cur}
     return conn, known_bills
 
 
-def _mark_as_processed(conn, bill_info: dict):
+def _migrate_cache(conn):
+    """Move the bills of the former cache table into 'cached_bills'
+
+    The former 'extracted_bills' table was keyed on the file basename, so two
+    bills with the same name in different folders evicted each other. Only
+    its rows with a known digest and library can be kept, the other bills
+    are extracted again.
+
+    Args:
+        conn (sqlite3.connection): the sqlite connection
+    """
+    columns = [row[1]
+               for row in conn.execute("PRAGMA table_info(extracted_bills)")]
+    if not columns:
+        return
+    if "digest" in columns and "pdf_parser" in columns:
+        conn.execute("""
+        INSERT OR IGNORE INTO cached_bills (digest, pdf_parser, file, bill_info, exctracted_at)
+        SELECT digest, pdf_parser, file, bill_info, exctracted_at FROM extracted_bills
+        WHERE digest IS NOT NULL AND pdf_parser IS NOT NULL
+        """)
+    conn.execute("DROP TABLE extracted_bills")
+
+
+def _mark_as_processed(conn, digest: str, pdf_parser: str, bill_info: dict):
     """Store the bill in the cache
 
     Args:
         conn (sqlite3.connection): the sqlite connection
+        digest (str): the digest of the bill file
+        pdf_parser (str): the library used to extract the text of the bill
         bill_info (dict): the bill information
     """
     bill_info_ser = json.dumps(bill_info)
     conn.execute(
-        "INSERT OR IGNORE INTO extracted_bills (file, bill_info) VALUES (?, ?)", (bill_info["file"], bill_info_ser, ))
+        "INSERT OR REPLACE INTO cached_bills (digest, pdf_parser, file, bill_info) VALUES (?, ?, ?, ?)", (digest, pdf_parser, bill_info["file"], bill_info_ser, ))
     conn.commit()
 
 
+def _file_digest(file: str) -> str:
+    """Return the digest of the content of a file
+
+    Args:
+        file (str): the path to the file
+
+    Returns:
+        str: the hexadecimal BLAKE2b digest of the file
+    """
+    with open(file, "rb") as f:
+        # file_digest reads the file into a reusable buffer without looping in Python
+        digest = hashlib.file_digest(
+            f, lambda: hashlib.blake2b(digest_size=16))
+    return digest.hexdigest()
+
+
 if __name__ == "__main__":
     sys.exit(main())